@@ -1,8 +1,17 @@
-from io import StringIO
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO, TextIOWrapper
+from itertools import islice
+import re
 import pyvisa as visa
 import numpy as np
 import requests
 
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
 FORMATTER_LOOKUP = {
     "1": {"RI": "b", "RP": "B"},
     "2": {"RI": "h", "RP": "H"},
@@ -10,6 +19,30 @@ FORMATTER_LOOKUP = {
     "8": {"RI": "q", "RP": "Q", "FP": "d"},
 }
 
+# Start of the curve block in a waveform saved with "save:waveform:fileformat internal" (.isf)
+ISF_CURVE_PATTERN = re.compile(rb";:CURVE? #")
+
+
+def _strip_header(reply):
+    """Drops the command header (e.g. ":SELECT:CH1 ") that prefixes query replies while header is ON"""
+    return reply.split(" ", 1)[-1]
+
+
+def _scale_and_bias(header):
+    """
+    Returns the waveform scaling of a wfmoutpre header as a single multiply-add, so that
+    ((raw - YOFF) * YMULT) + YZERO == raw * scale + bias
+    """
+    scale = float(header["YMULT"])
+    return scale, float(header["YZERO"]) - float(header["YOFF"]) * scale
+
+
+def _scale(values, scale, bias):
+    """Converts raw digitizer levels to vertical units in place"""
+    np.multiply(values, scale, out=values)
+    values += bias
+    return values
+
 
 class Oscilloscope:
     """
@@ -35,8 +68,17 @@ class Oscilloscope:
         """
         self.use_serial = use_serial
         self.scope = None
+        self._session = requests.Session()
+        self._cached_length = None
+        self._cached_format = {}
+        self._post_template = {
+            'WFMFILEEXT': 'csv',
+            'command1': 'save:waveform:fileformat spreadsheet',
+            'wfmsend': 'Get'
+        }
         if ip:
             self.ip = ip
+            self._url = f"http://{ip}:80/data/mdo_data4.html"
             if use_serial:
                 self.rm = visa.ResourceManager()
                 self.connect(ip)
@@ -49,7 +91,9 @@ class Oscilloscope:
         :param ip: IP address for the instrument
         :return:
         """
-        self.scope = self.rm.open_resource('TCPIP::{}::INSTR'.format(ip), write_termination='\n', read_termination='\n')
+        self.scope = self.rm.open_resource(f'TCPIP::{ip}::INSTR', write_termination='\n', read_termination='\n')
+        # The cached settings belong to the previous instrument
+        self.invalidate_cache()
 
     def set_timeout(self, seconds=5000):
         """
@@ -59,133 +103,249 @@ class Oscilloscope:
         """
         self.scope.timeout = seconds
 
-    def make_post(self, ch: str):
+    def invalidate_cache(self):
+        """
+        Clears the cached record length and data format. Call this after reconfiguring the instrument
+        :return:
+        """
+        self._cached_length = None
+        self._cached_format = {}
+
+    def _get_format(self, header):
+        """Returns the struct format character and endianness of the binary curve data described by header"""
+        key = (header["BYT_NR"], header["BN_FMT"], header["BYT_OR"])
+        if key not in self._cached_format:
+            self._cached_format[key] = (FORMATTER_LOOKUP[header["BYT_NR"]][header["BN_FMT"]], header["BYT_OR"] == "MSB")
+        return self._cached_format[key]
+
+    def make_post(self, ch: str, binary: bool = False):
         """
         Creates POST data for the HTTP request
         :param ch:
+        :param binary: Requests the waveform in the instrument's internal binary format (.isf) instead of CSV
         :return:
         """
-        return {
-            'WFMFILENAME': '{}'.format(ch.upper()),
-            'WFMFILEEXT': 'csv',
-            'command': 'select:control {}'.format(ch.lower()),
-            'command1': 'save:waveform:fileformat spreadsheet',
-            'wfmsend': 'Get'
+        post = {
+            **self._post_template,
+            'WFMFILENAME': ch.upper(),
+            'command': f'select:control {ch.lower()}'
         }
+        if binary:
+            post['WFMFILEEXT'] = 'isf'
+            post['command1'] = 'save:waveform:fileformat internal'
+        return post
 
     def make_request(self, data):
         """
         Sends the POST request to the instrument and returns the response body
         :param data: POST data as dict
-        :return:
+        :return: Response body as a text stream, or as bytes if binary data was requested
         """
-        osc_r = requests.post('http://{}:80/data/mdo_data4.html'.format(self.ip), data)
+        osc_r = self._session.post(self._url, data, stream=True)
         osc_r.raise_for_status()
 
         if osc_r.status_code == 200 and osc_r.reason == 'OK':
-            return osc_r.text
+            if data['WFMFILEEXT'] == 'isf':
+                return osc_r.content
+            # Hand out the body as a stream so parsing starts while the rest is still downloading.
+            # urllib3 would close the stream as soon as the body is read, before TextIOWrapper returns the
+            # buffered text, so closing is left to the caller
+            osc_r.raw.decode_content = True
+            osc_r.raw.auto_close = False
+            return TextIOWrapper(osc_r.raw, encoding=osc_r.encoding or "utf-8")
         else:
             print("Error contacting the device.")
 
     def parse_response(self, data_string):
         """
         Parses the response body of the HTTP request
-        :param data_string:
+        :param data_string: CSV response as str or text stream, or binary (.isf) response as bytes
         :return: Returns the channel data as WaveformCollection object
         """
-        data_string = StringIO(data_string)
+        if isinstance(data_string, bytes):
+            return self._parse_binary_response(data_string)
+        if isinstance(data_string, str):
+            data_string = StringIO(data_string)
         header = {}
         wf = WaveformCollection()
 
-        for _ in range(21):
-            line = data_string.readline()
-            words = line.strip().split(",")
+        for line in islice(data_string, 21):
+            words = line.rstrip("\r\n").split(",")
             if words[0] == "Label":
                 break
             if len(words) == 2 and words[0]:
                 header[words[0]] = words[1]
         header["label"] = data_string.readline().strip().split(",")
         wf["header"] = header
-        values = np.genfromtxt(data_string, delimiter=",", dtype=None)
+        values = np.loadtxt(data_string, delimiter=",", dtype=np.float64, ndmin=2)
+        # Transpose once so that every channel is a contiguous row
+        wf._set_matrix(header["label"], np.ascontiguousarray(values.T))
+        return wf
+
+    def _parse_binary_response(self, data):
+        """
+        Parses a waveform saved in the instrument's internal format (.isf)
+        :param data: Response body as bytes
+        :return: Returns the channel data as WaveformCollection object
+        """
+        match = ISF_CURVE_PATTERN.search(data)
+        if match is None:
+            raise ValueError("No curve data found in the binary response")
+        # The preamble is the same as a verbose wfmoutpre? reply, e.g. ":WFMPRE:BYT_NR 2;BIT_NR 16;..."
+        preamble = data[:match.start()].decode("latin-1").strip()
+        preamble = preamble.split(":", 2)[-1]
+        header = dict(x.split(" ", 1) for x in preamble.split(";"))
+
+        # Definite length block: #<number of digits><number of bytes><data>
+        block = match.end()
+        digits = int(data[block:block + 1])
+        length = int(data[block + 1:block + 1 + digits])
+        start = block + 1 + digits
+
+        byte_order = ">" if header["BYT_OR"] == "MSB" else "<"
+        dtype = np.dtype(byte_order + FORMATTER_LOOKUP[header["BYT_NR"]][header["BN_FMT"]])
+        samples = np.frombuffer(data, dtype=dtype, count=length // dtype.itemsize, offset=start)
+        values = _scale(samples.astype(np.float64), *_scale_and_bias(header))
+
+        # Same TIME column as in the CSV export: XZERO is the time of sample PT_OFF, samples are XINCR apart
+        time = (np.arange(len(values), dtype=np.float64) - float(header["PT_OFF"])) * float(header["XINCR"])
+        time += float(header["XZERO"])
 
-        for i, label in enumerate(header["label"], start=0):
-            wf[label] = values[:, i].tolist()
+        wf = WaveformCollection()
+        wf["header"] = header
+        wf["TIME"] = time
+        # WFID looks like "Ch1, DC coupling, 100.0mV/div, ..."
+        wf[header["WFID"].strip('"').split(",")[0].upper()] = values
         return wf
 
-    def get_data_http(self, channels: list):
+    def get_data_http(self, channels: list, binary: bool = False):
         """
         Requests the channel data via HTTP
         :param channels: Channels as a list
+        :param binary: Transfers the waveforms in binary format instead of CSV
         :return: Returns the channel data as WaveformCollection object
 
         """
+        posts = [self.make_post(ch, binary) for ch in channels]
+        # Each channel is an independent round-trip, so download and parse them concurrently
+        with ThreadPoolExecutor(max_workers=max(len(posts), 1)) as executor:
+            return self._combine(list(executor.map(self._request_and_parse, posts)))
+
+    async def get_data_http_async(self, channels: list, binary: bool = False):
+        """
+        Requests the channel data via HTTP from within an asyncio event loop, e.g. to poll several instruments
+        at once. Requires httpx
+        :param channels: Channels as a list
+        :param binary: Transfers the waveforms in binary format instead of CSV
+        :return: Returns the channel data as WaveformCollection object
+        """
+        if httpx is None:
+            raise ImportError("get_data_http_async requires httpx (pip install httpx)")
+        # Like the requests path, wait as long as the instrument needs to save the waveform
+        async with httpx.AsyncClient(timeout=None) as client:
+            responses = await asyncio.gather(
+                *(client.post(self._url, data=self.make_post(ch, binary)) for ch in channels)
+            )
+        for response in responses:
+            response.raise_for_status()
+        return self._combine([self.parse_response(response.content if binary else response.text)
+                              for response in responses])
+
+    def _combine(self, waveforms):
+        """Combines the WaveformCollections of the single channels into one"""
         data = None
-        for ch in channels:
+        for wf in waveforms:
             if data is None:
-                data = self.parse_response(self.make_request(self.make_post(ch)))
+                data = wf
             else:
-                data += self.parse_response(self.make_request(self.make_post(ch)))
+                data += wf
         return data
 
+    def _request_and_parse(self, data):
+        """Sends the POST request and parses the response body while it is downloading"""
+        response = self.make_request(data)
+        try:
+            return self.parse_response(response)
+        finally:
+            if isinstance(response, TextIOWrapper):
+                response.close()
+
     def _get_header(self, source):
-        """Returns the header as a dictionary so you can see configuration details"""
-        self.scope.write("data:source " + source)
-        self.scope.write("verbose ON;header ON")
-        result_string = self.scope.query("wfmoutpre?")
-        self.scope.write("verbose OFF;header OFF")
+        """
+        Returns the header of the current data source as a dictionary so you can see configuration details,
+        and whether the source is switched on. Expects verbose and header to be ON
+        """
+        # Ask for the display state in the same round-trip, the reply ends with ";:SELECT:<source> <state>"
+        result_string, _, selected = self.scope.query(f"wfmoutpre?;:select:{source}?").rpartition(";")
         result_string = result_string.replace(":WFMOUTPRE:", "", 1)
         # split on semicolons and break those into key/value pairs by splitting on space
-        return {x.split(" ")[0]: x.split(" ")[1] for x in result_string.split(";")}
+        return dict(x.split(" ", 1) for x in result_string.split(";")), _strip_header(selected)[0] != "0"
 
-    def _get_data_visa(self, sources, lower_bound=None, upper_bound=None):
-        """queries data and returns it along with the corresponding header"""
+    def _get_data_visa(self, sources, lower_bound=None, upper_bound=None, out=None):
+        """
+        queries data and returns it along with the corresponding header
+        :param out: Optional dict of preallocated float arrays by source. The binary data of those sources is
+            written into the given array instead of a new one, so repeated acquisitions do not allocate
+        """
+        start = 1 if lower_bound is None else lower_bound
+        # The record length is shared by all sources and rarely changes, so it is cached until invalidate_cache()
+        if upper_bound is None:
+            if self._cached_length is None:
+                self._cached_length = _strip_header(self.scope.query("horizontal:recordlength?"))
+            stop = self._cached_length
+        else:
+            stop = upper_bound
         for source in sources:
-            self.scope.write("data:source " + source)
-            if lower_bound is None:
-                self.scope.write("data:start 1")
-            else:
-                self.scope.write("data:start " + str(lower_bound))
-            length = self.scope.query("horizontal:recordlength?")
-            if upper_bound is None:
-                self.scope.write("data:stop " + length)
-            else:
-                self.scope.write("data:stop " + str(upper_bound))
-
-            header = self._get_header(source)
-            if self.scope.query("select:" + source + "?")[0] == "0":
-                # The channel we want to read is off. Just return empty data and the header
-                return [], header
-            y_mult = float(header["YMULT"])
-            y_offset = float(header["YOFF"])
-            y_zero = float(header["YZERO"])
-            ret_val = []
+            # Batch the setup commands into a single write to save round-trips
+            self.scope.write(f"data:source {source};:data:start {start};:data:stop {stop}")
+
+            header, selected = self._get_header(source)
+            if not selected:
+                # The channel we want to read is off. Return empty data and the header, and go on with the rest
+                yield (source, np.empty(0), header)
+                continue
+            scale, bias = _scale_and_bias(header)
+            ret_val = np.empty(0)
             if header["ENCDG"] == "ASCII":
-                read_string = self.scope.query("curve?")
-                ret_val = [
-                    ((float(entry) - y_offset) * y_mult) + y_zero
-                    for entry in read_string.split(",")
-                ]
+                read_string = _strip_header(self.scope.query("curve?"))
+                ret_val = np.fromstring(read_string, dtype=np.float64, sep=",")
+                _scale(ret_val, scale, bias)
             elif header["ENCDG"] == "BINARY":
-                format_string = FORMATTER_LOOKUP[header["BYT_NR"]][header["BN_FMT"]]
-                is_big_endian = header["BYT_OR"] == "MSB"
+                format_string, is_big_endian = self._get_format(header)
                 ret_val = self.scope.query_binary_values(
-                    "curv?", datatype=format_string, is_big_endian=is_big_endian
+                    "curv?", datatype=format_string, is_big_endian=is_big_endian, container=np.ndarray
                 )
-                ret_val = [((entry - y_offset) * y_mult) + y_zero for entry in ret_val]
+                if out is not None and source in out:
+                    # ret_val is a view on the received block, so this is the only copy of the samples
+                    np.copyto(out[source], ret_val)
+                    ret_val = out[source]
+                else:
+                    # Cast to a float copy, ret_val is a read-only view on the received block
+                    ret_val = ret_val.astype(np.float64)
+                _scale(ret_val, scale, bias)
             yield (source, ret_val, header)
 
-    def get_data_visa(self, channels: list):
+    def get_data_visa(self, channels: list, out: dict = None):
         """
         Requests the channel data via VISA connection
         :param channels: Channels as list
+        :param out: Optional dict of preallocated float arrays (one per channel, of the record length). Binary
+            data is written into these arrays and the returned collection uses them as its channel data, so
+            acquiring in a loop does not allocate new arrays
         :return: Returns the channel data as WaveformCollection object
         """
         wf = WaveformCollection()
         wf.idn = self.scope.query("*IDN?")
         if channels:
-            for ch_name, ch_data, ch_header in self._get_data_visa(channels):
-                wf[ch_name] = ch_data
-                wf["header"] = ch_header
+            # Keep verbose headers on for the whole sweep instead of toggling them for every source
+            self.scope.write("verbose ON;header ON")
+            try:
+                for ch_name, ch_data, ch_header in self._get_data_visa(channels, out=out):
+                    if len(ch_data):
+                        wf[ch_name] = ch_data
+                        wf["header"] = ch_header
+            finally:
+                self.scope.write("verbose OFF;header OFF")
         return wf
 
     def get_data(self, channels: list):
@@ -201,35 +361,87 @@ class Oscilloscope:
 
 
 class WaveformCollection:
+    """
+    Container for the acquired channels, indexed by the source name (e.g. data["CH1"]).
+    Channels of equal length share one (channels x samples) numpy matrix and data["CH1"]
+    returns the row of that channel as a contiguous view. Channels of different lengths (e.g. a
+    reference waveform next to live channels) are kept as separate arrays
+    """
+
     def __init__(self):
         self.idn = ""
         self._data = {}
+        self._matrix = None
         self._header = {}
 
     @property
     def sources(self):
-        return list(self._data.keys())
+        return list(self._data)
+
+    @property
+    def matrix(self):
+        """
+        Returns the channel data as a read-only (channels x samples) numpy array, rows ordered as sources.
+        Returns None if the channels have different lengths
+        """
+        if self._matrix is None:
+            self._stack()
+        if self._matrix is None:
+            return None
+        matrix = self._matrix.view()
+        matrix.flags.writeable = False
+        return matrix
+
+    def _set_matrix(self, labels, matrix):
+        """Takes over a (channels x samples) matrix, one row per label"""
+        self._matrix = matrix
+        self._data = dict(zip(labels, matrix))
+
+    def _stack(self):
+        """Stacks the channels into one matrix and makes them views of its rows, if they all have the same length"""
+        arrays = list(self._data.values())
+        if arrays and all(a.ndim == 1 and len(a) == len(arrays[0]) for a in arrays):
+            self._set_matrix(list(self._data), np.vstack(arrays))
 
     def header(self):
         return self._header
 
     def __getitem__(self, key):
+        """Returns the channel data as a numpy array"""
         return self._data[key]
 
     def __setitem__(self, key, value):
         if key == "header":
             self._header = value
+            return
+        value = np.asarray(value)
+        row = self._data.get(key)
+        if (self._matrix is not None and row is not None and value.shape == row.shape
+                and np.can_cast(value.dtype, row.dtype)):
+            row[...] = value
         else:
+            # New channels are stacked into the matrix once it is needed instead of on every assignment
             self._data[key] = value
+            self._matrix = None
 
     def __len__(self):
-        return len(self._data.keys())
+        return len(self._data)
 
     def __add__(self, other):
-        if self.idn == other.idn:
-            self._header.update(other.header())
-            for name in other.sources:
-                self[name] = other[name]
-            return self
-        else:
+        if self.idn != other.idn:
+            raise AttributeError("Incompatible addition")
+        wf = WaveformCollection()
+        wf.idn = self.idn
+        wf._header = {**self._header, **other._header}
+        wf._data = {**self._data, **other._data}
+        # Stack into a matrix of its own so the result does not share channel data with self or other
+        wf._stack()
+        return wf
+
+    def __iadd__(self, other):
+        if self.idn != other.idn:
             raise AttributeError("Incompatible addition")
+        self._header.update(other._header)
+        self._data.update(other._data)
+        self._matrix = None
+        return self